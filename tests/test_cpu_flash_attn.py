@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from whisper.cpu_flash_attn import cpu_flash_attn
+
+
+@pytest.mark.parametrize("n_q, n_k", [(1, 1500), (5, 5), (37, 300), (300, 1500)])
+@pytest.mark.parametrize("causal", [False, True])
+def test_cpu_flash_attn(n_q: int, n_k: int, causal: bool):
+    q = torch.randn(2, 4, n_q, 16)
+    k = torch.randn(2, 4, n_k, 16)
+    v = torch.randn(2, 4, n_k, 16)
+
+    mask = None
+    if causal:
+        mask = torch.full((n_k, n_k), -torch.inf).triu_(1)[n_k - n_q :]
+
+    scores = q @ k.transpose(-1, -2) / 4.0
+    if mask is not None:
+        scores = scores + mask
+    expected = scores.softmax(dim=-1) @ v
+
+    actual = cpu_flash_attn(q, k, v, mask, block_size=128)
+    assert torch.allclose(actual, expected, atol=1e-5)
@@ -0,0 +1,176 @@
+from contextlib import nullcontext
+
+import pytest
+import torch
+
+import whisper
+from whisper.model import (
+    ModelDimensions,
+    QuantLinear,
+    Whisper,
+    disable_sdpa,
+)
+
+
+def random_model(**kwargs) -> Whisper:
+    torch.manual_seed(0)
+    dims = dict(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=64,
+        n_audio_head=4,
+        n_audio_layer=2,
+        n_vocab=51865,
+        n_text_ctx=448,
+        n_text_state=64,
+        n_text_head=4,
+        n_text_layer=2,
+    )
+    model = Whisper(ModelDimensions(**{**dims, **kwargs}))
+    for p in model.parameters():
+        torch.nn.init.normal_(p, std=0.2)
+    return model.eval()
+
+
+def test_fused_qkv():
+    model = random_model()
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.randint(0, 50000, (1, 8))
+    with torch.no_grad():
+        expected = model(mel, tokens)
+
+    model.fuse_weights()
+    model.half().float()
+    with torch.no_grad():
+        assert torch.allclose(model(mel, tokens), expected, atol=1e-2)
+
+    attn = model.decoder.blocks[0].attn
+    x = torch.randn(1, 8, 64)
+    state_dict = {k: v + 1 for k, v in model.state_dict().items()}
+    model.load_state_dict(state_dict)
+    with torch.no_grad():
+        assert torch.allclose(attn.qkv(x)[0], attn.query(x))
+
+    model(mel, tokens).sum().backward()
+    assert model.encoder.blocks[0].attn.query.weight.grad is not None
+
+    model.quantize_weights()
+    model.fuse_weights()
+    assert attn.qkv_weight is None
+
+
+def test_decode_step():
+    model = random_model()
+    xa = torch.randn(2, 1500, 64)
+    tokens = torch.randint(0, 50000, (2, 12))
+    with torch.no_grad():
+        expected = model.decoder(tokens, xa)
+
+        self_kv, cross_kv = model.new_kv_cache(2, xa)
+        offset = torch.tensor([0])
+        logits = [model.decode_step(tokens[:, :4], xa, self_kv, cross_kv, offset)]
+        for i in range(4, tokens.shape[1]):
+            offset = torch.tensor([i])
+            step = model.decode_step(
+                tokens[:, i : i + 1], xa, self_kv, cross_kv, offset
+            )
+            logits.append(step)
+
+    assert torch.allclose(torch.cat(logits, dim=1), expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("n_rows", [1, 5, 100])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_quant_linear(n_rows: int, dtype: torch.dtype):
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(256, 512).to(dtype)
+    x = torch.randn(n_rows, 1, 256, dtype=dtype)
+    expected = linear(x).float()
+    actual = QuantLinear(linear)(x)
+    assert actual.dtype == dtype
+    error = (actual.float() - expected).norm() / expected.norm()
+    assert error < 2e-2
+
+
+def test_batched_beam_search():
+    model = random_model()
+    mel = torch.randn(2, 80, 3000)
+    options = whisper.DecodingOptions(
+        language="en", beam_size=5, sample_len=20, fp16=False
+    )
+    results = whisper.decode(model, mel, options)
+    for i, result in enumerate(results):
+        expected = whisper.decode(model, mel[i : i + 1], options)[0]
+        assert result.tokens == expected.tokens
+        assert abs(result.avg_logprob - expected.avg_logprob) < 1e-4
+
+
+def test_quantized_compiled_decode():
+    model = random_model()
+    mel = torch.randn(1, 80, 3000)
+    options = whisper.DecodingOptions(language="en", sample_len=10, fp16=False)
+
+    model.quantize_weights()
+    expected = whisper.decode(model, mel, options)[0]
+    model.compile_decode_step()
+    result = whisper.decode(model, mel, options)[0]
+    assert result.tokens == expected.tokens
+
+
+@pytest.mark.parametrize("fused", [False, True])
+def test_kv_cache_hooks(fused: bool):
+    model = random_model()
+    if fused:
+        model.fuse_weights()
+    xa = torch.randn(2, 1500, 64)
+    tokens = torch.randint(0, 50000, (2, 12))
+    with torch.no_grad():
+        expected = model.decoder(tokens, xa)
+
+        cache, hooks = model.install_kv_cache_hooks()
+        logits = [model.decoder(tokens[:, :4], xa, kv_cache=cache)]
+        for i in range(4, 8):
+            logits.append(model.decoder(tokens[:, i : i + 1], xa, kv_cache=cache))
+        logits.append(model.decoder(tokens[:, 8:], xa, kv_cache=cache))
+        for hook in hooks:
+            hook.remove()
+
+    assert cache[0, "k"].shape == (2, 12, 64)
+    assert torch.allclose(torch.cat(logits, dim=1), expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("use_sdpa", [False, True])
+def test_alignment_scores(use_sdpa: bool):
+    model = random_model(n_text_layer=6, n_text_head=8)
+    model.set_alignment_heads(b"ABzY8KQ!870{>%RzyTQH3`Q^yNP!>##QT-<FaQ7m")
+    xa = torch.randn(2, 1500, 64)
+    tokens = torch.randint(0, 50000, (2, 12))
+
+    scores = [None] * model.dims.n_text_layer
+    hooks = [
+        block.cross_attn.register_forward_hook(
+            lambda _, ins, outs, index=i: scores.__setitem__(index, outs[-1])
+        )
+        for i, block in enumerate(model.decoder.blocks)
+    ]
+
+    with torch.no_grad(), disable_sdpa():
+        for block in model.decoder.blocks:
+            block.cross_attn._return_scores = True
+        model.decoder(tokens, xa)
+        for block in model.decoder.blocks:
+            block.cross_attn._return_scores = False
+    full = torch.stack(scores)
+    layers, heads = model.alignment_head_layers, model.alignment_head_indices
+    expected = full[layers, :, heads].transpose(0, 1)
+
+    scores = [None] * model.dims.n_text_layer
+    sdpa_context = nullcontext() if use_sdpa else disable_sdpa()
+    with torch.no_grad(), model.alignment_scores(), sdpa_context:
+        model.decoder(tokens, xa)
+    for hook in hooks:
+        hook.remove()
+
+    assert [qk is not None for qk in scores] == [i in layers for i in range(6)]
+    actual = torch.cat([qk for qk in scores if qk is not None], dim=1)
+    assert torch.allclose(actual, expected, atol=1e-4)
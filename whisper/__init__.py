@@ -101,6 +101,7 @@ def load_model(
     device: Optional[Union[str, torch.device]] = None,
     download_root: str = None,
     in_memory: bool = False,
+    dtype: Optional[torch.dtype] = None,
 ) -> Whisper:
     """
     Load a Whisper ASR model
@@ -116,6 +117,10 @@ def load_model(
         path to download the model files; by default, it uses "~/.cache/whisper"
     in_memory: bool
         whether to preload the model weights into host memory
+    dtype: torch.dtype
+        the dtype to convert the model parameters into, e.g. torch.float16 for fp16 inference
+        on GPUs, which avoids casting the weights to the activation dtype in every layer call;
+        by default, the parameters are kept in float32
 
     Returns
     -------
@@ -153,4 +158,7 @@ def load_model(
     if alignment_heads is not None:
         model.set_alignment_heads(alignment_heads)
 
-    return model.to(device)
+    model = model.to(device, dtype)
+    model.fuse_weights()
+
+    return model
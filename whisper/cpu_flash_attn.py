@@ -0,0 +1,48 @@
+from typing import Optional
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+def cpu_flash_attn(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    mask: Optional[Tensor] = None,
+    block_size: int = 128,
+) -> Tensor:
+    """
+    Computes `softmax(q @ k.T / sqrt(head_dim) + mask) @ v` over tiles of `block_size` keys,
+    keeping the running maxima and sums of the online softmax for each query, so that only a
+    (n_q, block_size) slice of the attention scores is alive at a time instead of (n_q, n_k).
+
+    q : torch.Tensor, shape = (*, n_q, head_dim)
+    k, v : torch.Tensor, shape = (*, n_k, head_dim)
+    mask : torch.Tensor, shape = (n_q, n_k), added to the scores
+    """
+    n_k = k.shape[-2]
+    q = q * q.shape[-1] ** -0.5
+
+    row_max = torch.full((*q.shape[:-1], 1), -np.inf, device=q.device)
+    row_sum = torch.zeros((*q.shape[:-1], 1), device=q.device)
+    out = torch.zeros((*q.shape[:-1], v.shape[-1]), device=q.device)
+
+    for start in range(0, n_k, block_size):
+        end = min(start + block_size, n_k)
+        scores = q @ k[..., start:end, :].transpose(-1, -2)
+        if mask is not None:
+            scores = scores + mask[..., start:end]
+        scores = scores.float()
+
+        new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+        # keep the rows that are fully masked so far from producing (-inf) - (-inf) = nan
+        new_max = new_max.masked_fill(new_max == -np.inf, 0)
+        correction = torch.exp(row_max - new_max)
+        weights = torch.exp(scores - new_max)
+
+        row_sum = row_sum * correction + weights.sum(dim=-1, keepdim=True)
+        out = out * correction + (weights.to(v.dtype) @ v[..., start:end, :]).float()
+        row_max = new_max
+
+    return (out / row_sum).to(q.dtype)
@@ -145,35 +145,34 @@ class PyTorchInference(Inference):
     def __init__(self, model: "Whisper", initial_token_length: int):
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
-        self.kv_cache = {}
-        self.hooks = []
-
-        key_modules = [block.attn.key for block in self.model.decoder.blocks]
-        value_modules = [block.attn.value for block in self.model.decoder.blocks]
-        self.kv_modules = key_modules + value_modules
+        self.kv_cache = None
+        self.n_cached = 0  # the number of positions filled in the key/value cache
 
     def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
-        if not self.kv_cache:
-            self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+        if self.kv_cache is None:
+            self.kv_cache = self.model.new_kv_cache(tokens.shape[0], audio_features)
 
+        offset = 0
         if tokens.shape[-1] > self.initial_token_length:
             # only need to use the last token except in the first forward pass
+            offset = tokens.shape[-1] - 1
             tokens = tokens[:, -1:]
 
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+        self.n_cached = offset + tokens.shape[-1]
+        offset = torch.tensor([offset], device=tokens.device)
+        return self.model.decode_step(tokens, audio_features, *self.kv_cache, offset)
 
     def cleanup_caching(self):
-        for hook in self.hooks:
-            hook.remove()
-
-        self.kv_cache = {}
-        self.hooks = []
+        self.kv_cache = None
+        self.n_cached = 0
 
     def rearrange_kv_cache(self, source_indices):
         if source_indices != list(range(len(source_indices))):
-            for module in self.kv_modules:
-                # update the key/value cache to contain the selected sequences
-                self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+            self_kv, _ = self.kv_cache
+            for cache in self_kv:
+                # update the filled positions of the key/value cache to contain the selected sequences
+                cache = cache[:, :, : self.n_cached]
+                cache.copy_(cache[:, source_indices])
 
 
 class SequenceRanker:
@@ -730,14 +729,15 @@ class DecodingTask:
                 )
             ]
 
-        # repeat text tensors by the group size, for beam search or best-of-n sampling
+        # repeat text tensors by the group size, for beam search or best-of-n sampling;
+        # all sequences go through the decoder as a single batch, while the inference
+        # repeats the cross-attention keys and values instead of the audio features
         tokens = tokens.repeat_interleave(self.n_group, dim=0).to(audio_features.device)
 
         # call the main sampling loop
         tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens)
 
         # reshape the tensors to have (n_audio, n_group) as the first two dimensions
-        audio_features = audio_features[:: self.n_group]
         no_speech_probs = no_speech_probs[:: self.n_group]
         assert audio_features.shape[0] == len(no_speech_probs) == n_audio
 
@@ -1,17 +1,38 @@
 import base64
 import gzip
+import warnings
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, Iterable, Optional
+from typing import Dict, Iterable, Optional, Tuple
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
 
+from .cpu_flash_attn import cpu_flash_attn
 from .decoding import decode as decode_function
 from .decoding import detect_language as detect_language_function
 from .transcribe import transcribe as transcribe_function
 
+try:
+    from torch.nn.functional import scaled_dot_product_attention
+
+    SDPA_AVAILABLE = True
+except (ImportError, RuntimeError, OSError):
+    scaled_dot_product_attention = None
+    SDPA_AVAILABLE = False
+
+try:
+    from torch.compiler import is_compiling
+except ImportError:
+
+    def is_compiling() -> bool:
+        return False
+
+
+INT8PACK_MM_AVAILABLE = hasattr(torch.ops.aten, "_weight_int8pack_mm")
+
 
 @dataclass
 class ModelDimensions:
@@ -29,11 +50,22 @@ class ModelDimensions:
 
 class LayerNorm(nn.LayerNorm):
     def forward(self, x: Tensor) -> Tensor:
-        return super().forward(x.float()).type(x.dtype)
+        if x.dtype == self.weight.dtype and (x.dtype == torch.float32 or x.is_cuda):
+            # the CUDA kernels accumulate in float32 for half-precision inputs
+            return super().forward(x)
+        return F.layer_norm(
+            x.float(),
+            self.normalized_shape,
+            self.weight.float(),
+            self.bias.float(),
+            self.eps,
+        ).type(x.dtype)
 
 
 class Linear(nn.Linear):
     def forward(self, x: Tensor) -> Tensor:
+        if x.dtype == self.weight.dtype:
+            return super().forward(x)
         return F.linear(
             x,
             self.weight.to(x.dtype),
@@ -45,29 +77,103 @@ class Conv1d(nn.Conv1d):
     def _conv_forward(
         self, x: Tensor, weight: Tensor, bias: Optional[Tensor]
     ) -> Tensor:
+        if x.dtype == weight.dtype:
+            return super()._conv_forward(x, weight, bias)
         return super()._conv_forward(
             x, weight.to(x.dtype), None if bias is None else bias.to(x.dtype)
         )
 
 
+class QuantLinear(nn.Module):
+    """
+    A linear layer with int8 weights and a float scale for each output channel, which computes
+    `(x @ weight_int8.T) * scale + bias`. On CPU, inputs of a few rows such as the decoding
+    steps use the int8 kernel with bfloat16 activations; otherwise, e.g. for the encoder, on
+    other devices, or under `torch.compile` which cannot lower the kernel, the weights are
+    dequantized on each call.
+    """
+
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-12) / 127
+        weight_int8 = torch.round(weight / scale[:, None]).to(torch.int8)
+        bias = None if linear.bias is None else linear.bias.detach().clone()
+        self.register_buffer("weight_int8", weight_int8)
+        self.register_buffer("scale", scale.to(linear.weight.dtype))
+        self.register_buffer("bias", bias)
+        # the scale in the dtype of the int8 kernel, kept in bfloat16 by `_apply()`
+        self.register_buffer("scale_bf16", scale.to(torch.bfloat16), persistent=False)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        self.scale_bf16 = self.scale.to(torch.bfloat16)
+        return self
+
+    def forward(self, x: Tensor) -> Tensor:
+        x2d = x.reshape(-1, x.shape[-1])
+        if (
+            INT8PACK_MM_AVAILABLE
+            and x.device.type == "cpu"
+            and x2d.shape[0] <= 8  # the CPU kernel is only faster for a few rows
+            and not is_compiling()
+        ):
+            y = torch.ops.aten._weight_int8pack_mm(
+                x2d.to(torch.bfloat16).contiguous(), self.weight_int8, self.scale_bf16
+            )
+            y = y.view(*x.shape[:-1], -1).to(x.dtype)
+        else:
+            weight = self.weight_int8.to(x.dtype)
+            y = F.linear(x, weight) * self.scale.to(x.dtype)
+        if self.bias is not None:
+            y = y + self.bias.to(x.dtype)
+        return y
+
+
 def sinusoids(length, channels, max_timescale=10000):
     """Returns sinusoids for positional embedding"""
     assert channels % 2 == 0
     log_timescale_increment = np.log(max_timescale) / (channels // 2 - 1)
     inv_timescales = torch.exp(-log_timescale_increment * torch.arange(channels // 2))
     scaled_time = torch.arange(length)[:, np.newaxis] * inv_timescales[np.newaxis, :]
-    return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1)
+    out = torch.empty(length, channels)
+    torch.sin(scaled_time, out=out[:, : channels // 2])
+    torch.cos(scaled_time, out=out[:, channels // 2 :])
+    return out
+
+
+@contextmanager
+def disable_sdpa():
+    prev_state = MultiHeadAttention.use_sdpa
+    try:
+        MultiHeadAttention.use_sdpa = False
+        yield
+    finally:
+        MultiHeadAttention.use_sdpa = prev_state
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, n_state: int, n_head: int):
+    use_sdpa = True
+
+    def __init__(self, n_state: int, n_head: int, layer_id: int = 0):
         super().__init__()
         self.n_head = n_head
+        # the index of the enclosing block, used to key the entries of `kv_cache`
+        self._layer_id = layer_id
         self.query = Linear(n_state, n_state)
         self.key = Linear(n_state, n_state, bias=False)
         self.value = Linear(n_state, n_state)
         self.out = Linear(n_state, n_state)
 
+        # the attention scores are only computed when requested, e.g. for word timestamps,
+        # and only for `_score_heads` (all heads if None); see `Whisper.alignment_scores()`
+        self._return_scores: bool = False
+        self._score_heads: Optional[Tensor] = None
+
+        # the concatenated query/key/value projections for self-attention; see `fuse_qkv()`
+        self.register_buffer("qkv_weight", None, persistent=False)
+        self.register_buffer("qkv_bias", None, persistent=False)
+
     def forward(
         self,
         x: Tensor,
@@ -75,48 +181,171 @@ class MultiHeadAttention(nn.Module):
         mask: Optional[Tensor] = None,
         kv_cache: Optional[dict] = None,
     ):
-        q = self.query(x)
-
-        if kv_cache is None or xa is None or self.key not in kv_cache:
-            # hooks, if installed (i.e. kv_cache is not None), will prepend the cached kv tensors;
-            # otherwise, perform key/value projections for self- or cross-attention as usual.
-            k = self.key(x if xa is None else xa)
-            v = self.value(x if xa is None else xa)
+        if xa is None and kv_cache is None:
+            q, k, v = self.qkv(x)
         else:
-            # for cross-attention, calculate keys and values once and reuse in subsequent calls.
-            k = kv_cache[self.key]
-            v = kv_cache[self.value]
+            q = self.query(x)
+
+            if (
+                kv_cache is None
+                or xa is None
+                or (self._layer_id, "cross_k") not in kv_cache
+            ):
+                # hooks, if installed (i.e. kv_cache is not None), will prepend the cached kv tensors;
+                # otherwise, perform key/value projections for self- or cross-attention as usual.
+                k = self.key(x if xa is None else xa)
+                v = self.value(x if xa is None else xa)
+            else:
+                # for cross-attention, calculate keys and values once and reuse in subsequent calls.
+                k = kv_cache[self._layer_id, "cross_k"]
+                v = kv_cache[self._layer_id, "cross_v"]
 
         wv, qk = self.qkv_attention(q, k, v, mask)
         return self.out(wv), qk
 
+    def forward_with_cache(
+        self,
+        x: Tensor,
+        k_cache: Tensor,
+        v_cache: Tensor,
+        positions: Tensor,
+        mask: Tensor,
+    ):
+        """
+        Self-attention against preallocated key/value buffers of shape (batch_size, n_ctx, n_state);
+        the keys and values of `x` are written at `positions`, and the whole buffers are attended
+        over with `mask` hiding the positions that are not filled yet, so that all shapes are static.
+        """
+        q, k, v = self.qkv(x)
+        k_cache.index_copy_(1, positions, k)
+        v_cache.index_copy_(1, positions, v)
+
+        wv, qk = self.qkv_attention(q, k_cache, v_cache, mask)
+        return self.out(wv), qk
+
+    def qkv(self, x: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Self-attention projections of `x`, in a single matmul if `fuse_qkv()` was called; the
+        fused weights are detached, so the separate projections are used when grad is enabled.
+        """
+        if self.qkv_weight is None or torch.is_grad_enabled():
+            return self.query(x), self.key(x), self.value(x)
+        qkv = F.linear(x, self.qkv_weight.to(x.dtype), self.qkv_bias.to(x.dtype))
+        return qkv.chunk(3, dim=-1)
+
+    def fuse_qkv(self):
+        """
+        Concatenates the query/key/value projection weights, so that self-attention computes them
+        with a single matmul. The separate projections, which are still used for cross-attention
+        and the kv-cache hooks, are updated to share the storage of the concatenated weights;
+        the fusion is redone whenever the module is converted, e.g. with `.to()` or `.half()`.
+        Quantized projections are left as they are.
+        """
+        if not all(
+            isinstance(m, nn.Linear) for m in [self.query, self.key, self.value]
+        ):
+            self.qkv_weight = self.qkv_bias = None
+            return
+
+        n_state = self.query.weight.shape[0]
+        weight = torch.cat([self.query.weight, self.key.weight, self.value.weight])
+        bias = torch.cat(
+            [self.query.bias, torch.zeros_like(self.query.bias), self.value.bias]
+        )
+        self.qkv_weight, self.qkv_bias = weight.detach(), bias.detach()
+
+        linears = [self.query, self.key, self.value]
+        for linear, weight in zip(linears, self.qkv_weight.split(n_state)):
+            linear.weight.data = weight
+        self.query.bias.data = self.qkv_bias[:n_state]
+        self.value.bias.data = self.qkv_bias[2 * n_state :]
+
+    def _apply(self, fn, *args, **kwargs):
+        # converting the parameters unshares them with the fused weights, so fuse them again
+        fused = self.qkv_weight is not None
+        self.qkv_weight = self.qkv_bias = None
+        super()._apply(fn, *args, **kwargs)
+        if fused:
+            self.fuse_qkv()
+        return self
+
+    def forward_with_kv(self, x: Tensor, k: Tensor, v: Tensor):
+        """Attention using precomputed keys and values, e.g. for cross-attention"""
+        wv, qk = self.qkv_attention(self.query(x), k, v)
+        return self.out(wv), qk
+
     def qkv_attention(
         self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None
-    ):
+    ) -> Tuple[Tensor, Optional[Tensor]]:
         n_batch, n_ctx, n_state = q.shape
-        scale = (n_state // self.n_head) ** -0.25
-        q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3) * scale
-        k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 3, 1) * scale
+        k_ctx = k.shape[1]
+        q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+        k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
 
-        qk = q @ k
-        if mask is not None:
-            qk = qk + mask[:n_ctx, :n_ctx]
-        qk = qk.float()
+        if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
+            if mask is not None and n_ctx == k_ctx:
+                # a square causal mask is better served by the fused causal kernels
+                a = scaled_dot_product_attention(q, k, v, is_causal=True)
+            else:
+                a = scaled_dot_product_attention(q, k, v, attn_mask=mask)
+            out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
+
+            qk = None
+            if self._return_scores:
+                # a separate pass restricted to the requested heads
+                heads = self._score_heads
+                if heads is not None:
+                    q, k = q[:, heads], k[:, heads]
+                qk = self.qk_scores(q, k, mask).detach()
+        elif q.device.type == "cpu" and n_ctx > 1 and not self._return_scores:
+            # tiled attention, which does not materialize the (n_ctx, k_ctx) scores at once
+            a = cpu_flash_attn(q, k, v, mask)
+            out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
+            qk = None
+        else:
+            qk = self.qk_scores(q, k, mask)
+            w = F.softmax(qk, dim=-1).to(q.dtype)
+            out = (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2)
+
+            if not self._return_scores:
+                qk = None
+            elif self._score_heads is not None:
+                qk = qk[:, self._score_heads].detach()
+            else:
+                qk = qk.detach()
+
+        return out, qk
 
-        w = F.softmax(qk, dim=-1).to(q.dtype)
-        return (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2), qk.detach()
+    @staticmethod
+    def qk_scores(q: Tensor, k: Tensor, mask: Optional[Tensor] = None) -> Tensor:
+        """Returns the pre-softmax attention scores in float32, shape = (*, n_ctx, k_ctx)"""
+        scale = q.shape[-1] ** -0.5
+        if mask is None:
+            qk = (q * scale) @ k.transpose(-1, -2)
+        else:
+            # scale, matmul and mask addition in a single batched kernel
+            qk = torch.baddbmm(
+                mask, q.flatten(0, -3), k.flatten(0, -3).transpose(-1, -2), alpha=scale
+            ).view(*q.shape[:-1], -1)
+        return qk.float()
 
 
 class ResidualAttentionBlock(nn.Module):
-    def __init__(self, n_state: int, n_head: int, cross_attention: bool = False):
+    def __init__(
+        self,
+        n_state: int,
+        n_head: int,
+        cross_attention: bool = False,
+        layer_id: int = 0,
+    ):
         super().__init__()
 
-        self.attn = MultiHeadAttention(n_state, n_head)
+        self.attn = MultiHeadAttention(n_state, n_head, layer_id)
         self.attn_ln = LayerNorm(n_state)
 
         self.cross_attn = (
-            MultiHeadAttention(n_state, n_head) if cross_attention else None
+            MultiHeadAttention(n_state, n_head, layer_id) if cross_attention else None
         )
         self.cross_attn_ln = LayerNorm(n_state) if cross_attention else None
 
@@ -139,6 +368,20 @@ class ResidualAttentionBlock(nn.Module):
         x = x + self.mlp(self.mlp_ln(x))
         return x
 
+    def forward_with_cache(
+        self,
+        x: Tensor,
+        self_kv: Tuple[Tensor, Tensor],
+        cross_kv: Tuple[Tensor, Tensor],
+        positions: Tensor,
+        mask: Tensor,
+    ):
+        h = self.attn_ln(x)
+        x = x + self.attn.forward_with_cache(h, *self_kv, positions, mask)[0]
+        x = x + self.cross_attn.forward_with_kv(self.cross_attn_ln(x), *cross_kv)[0]
+        x = x + self.mlp(self.mlp_ln(x))
+        return x
+
 
 class AudioEncoder(nn.Module):
     def __init__(
@@ -150,7 +393,10 @@ class AudioEncoder(nn.Module):
         self.register_buffer("positional_embedding", sinusoids(n_ctx, n_state))
 
         self.blocks: Iterable[ResidualAttentionBlock] = nn.ModuleList(
-            [ResidualAttentionBlock(n_state, n_head) for _ in range(n_layer)]
+            [
+                ResidualAttentionBlock(n_state, n_head, layer_id=i)
+                for i in range(n_layer)
+            ]
         )
         self.ln_post = LayerNorm(n_state)
 
@@ -164,7 +410,7 @@ class AudioEncoder(nn.Module):
         x = x.permute(0, 2, 1)
 
         assert x.shape[1:] == self.positional_embedding.shape, "incorrect audio shape"
-        x = (x + self.positional_embedding).to(x.dtype)
+        x = x.add_(self.positional_embedding.to(x.dtype))
 
         for block in self.blocks:
             x = block(x)
@@ -184,8 +430,10 @@ class TextDecoder(nn.Module):
 
         self.blocks: Iterable[ResidualAttentionBlock] = nn.ModuleList(
             [
-                ResidualAttentionBlock(n_state, n_head, cross_attention=True)
-                for _ in range(n_layer)
+                ResidualAttentionBlock(
+                    n_state, n_head, cross_attention=True, layer_id=i
+                )
+                for i in range(n_layer)
             ]
         )
         self.ln = LayerNorm(n_state)
@@ -200,20 +448,58 @@ class TextDecoder(nn.Module):
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
         """
-        offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
-        x = (
-            self.token_embedding(x)
-            + self.positional_embedding[offset : offset + x.shape[-1]]
-        )
+        offset = kv_cache[0, "k"].shape[1] if kv_cache else 0
+        n_ctx = x.shape[-1]
+        x = self.token_embedding(x) + self.positional_embedding[offset : offset + n_ctx]
         x = x.to(xa.dtype)
 
+        # a single query can attend to all cached positions, so it needs no mask;
+        # otherwise slice and cast the causal mask once and share it among the blocks
+        mask = None
+        if n_ctx > 1:
+            mask = self.mask[offset : offset + n_ctx, : offset + n_ctx].to(x.dtype)
+
         for block in self.blocks:
-            x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
+            x = block(x, xa, mask=mask, kv_cache=kv_cache)
+
+        x = self.ln(x)
+        # the output projection is tied to the token embedding, used in its (n_vocab, n_state) layout
+        logits = F.linear(x, self.token_embedding.weight.to(x.dtype)).float()
+
+        return logits
+
+    def forward_with_cache(
+        self,
+        x: Tensor,
+        xa: Tensor,
+        self_kv: Tuple[Tensor, Tensor],
+        cross_kv: Tuple[Tensor, Tensor],
+        offset: Tensor,
+    ):
+        """
+        x : torch.LongTensor, shape = (batch_size, n_tokens)
+            the text tokens at the positions starting from `offset`
+        xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
+            the encoded audio features, only used for its dtype
+        self_kv : Tuple[Tensor, Tensor]
+            the self-attention key and value buffers, indexed by layer first;
+            see `Whisper.new_kv_cache()`
+        cross_kv : Tuple[Tensor, Tensor]
+            the cross-attention keys and values of the audio features, indexed by layer first
+        offset : torch.LongTensor, shape = (1,)
+            the position of the first token in `x`
+        """
+        positions = offset + torch.arange(x.shape[-1], device=offset.device)
+        x = self.token_embedding(x) + self.positional_embedding[positions]
+        x = x.to(xa.dtype)
+        mask = self.mask[positions].to(x.dtype)
+
+        for block, k, v, cross_k, cross_v in zip(self.blocks, *self_kv, *cross_kv):
+            x = block.forward_with_cache(x, (k, v), (cross_k, cross_v), positions, mask)
 
         x = self.ln(x)
-        logits = (
-            x @ torch.transpose(self.token_embedding.weight.to(x.dtype), 0, 1)
-        ).float()
+        # the output projection is tied to the token embedding, used in its (n_vocab, n_state) layout
+        logits = F.linear(x, self.token_embedding.weight.to(x.dtype)).float()
 
         return logits
 
@@ -242,20 +528,55 @@ class Whisper(nn.Module):
             self.dims.n_text_layer, self.dims.n_text_head, dtype=torch.bool
         )
         all_heads[self.dims.n_text_layer // 2 :] = True
-        self.register_buffer("alignment_heads", all_heads.to_sparse(), persistent=False)
+        layers, heads = all_heads.nonzero(as_tuple=True)
+        self.register_buffer("alignment_head_layers", layers, persistent=False)
+        self.register_buffer("alignment_head_indices", heads, persistent=False)
+        self._compiled_decode_step = None
 
     def set_alignment_heads(self, dump: bytes):
-        array = np.frombuffer(
-            gzip.decompress(base64.b85decode(dump)), dtype=bool
-        ).copy()
-        mask = torch.from_numpy(array).reshape(
+        # a bytearray is writable, so torch.frombuffer can use it without copying
+        array = bytearray(gzip.decompress(base64.b85decode(dump)))
+        mask = torch.frombuffer(array, dtype=torch.bool).reshape(
             self.dims.n_text_layer, self.dims.n_text_head
         )
-        self.register_buffer("alignment_heads", mask.to_sparse(), persistent=False)
+        layers, heads = mask.nonzero(as_tuple=True)
+        self.register_buffer("alignment_head_layers", layers, persistent=False)
+        self.register_buffer("alignment_head_indices", heads, persistent=False)
+
+    @contextmanager
+    def alignment_scores(self):
+        """
+        Within this context, the cross-attention modules of the decoder layers that contain
+        alignment heads return the attention scores of those heads as the second output,
+        in the (layer, head) order of the alignment heads. Other modules return None.
+        """
+        attns = [block.cross_attn for block in self.decoder.blocks]
+        layers, heads = self.alignment_head_layers, self.alignment_head_indices
+        for i, attn in enumerate(attns):
+            attn._score_heads = heads[layers == i]
+            attn._return_scores = len(attn._score_heads) > 0
+        try:
+            yield
+        finally:
+            for attn in attns:
+                attn._return_scores = False
+                attn._score_heads = None
 
     def embed_audio(self, mel: torch.Tensor):
         return self.encoder(mel)
 
+    def cross_attention_kv(self, audio_features: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Returns the cross-attention keys and values of `audio_features` for all decoder layers,
+        each of shape (n_text_layer, batch_size, n_audio_ctx, n_text_state)
+        """
+        blocks = self.decoder.blocks
+        keys = torch.stack([block.cross_attn.key(audio_features) for block in blocks])
+        values = torch.stack(
+            [block.cross_attn.value(audio_features) for block in blocks]
+        )
+        return keys, values
+
     def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor):
         return self.decoder(tokens, audio_features)
 
@@ -276,6 +597,112 @@ class Whisper(nn.Module):
     def num_languages(self):
         return self.dims.n_vocab - 51765 - int(self.is_multilingual)
 
+    def fuse_weights(self):
+        """
+        Fuses the self-attention query/key/value projections of every layer into a single matmul;
+        see `MultiHeadAttention.fuse_qkv()`. The fused weights are only used for inference, i.e.
+        when grad is disabled, and the layers already replaced by `quantize_weights()` are skipped.
+        """
+        for block in [*self.encoder.blocks, *self.decoder.blocks]:
+            block.attn.fuse_qkv()
+
+    def quantize_weights(self, attention_out: bool = False):
+        """
+        Replaces the Linear layers of the attention and MLP blocks with int8 `QuantLinear`
+        layers using per-output-channel scales, which reduces the weight memory traffic that
+        dominates the decoding steps. The fused self-attention projections are dropped, so that
+        the quantized query/key/value projections are used instead. This is only beneficial on
+        CPU, where the decoding steps use an int8 kernel; on other devices, the weights are
+        dequantized on every call.
+
+        Parameters
+        ----------
+        attention_out : bool
+            whether to quantize the attention output projections as well, which are the most
+            sensitive to quantization along with the output projection tied to the token embedding;
+            the latter is always kept in floating point
+        """
+        if self.device.type != "cpu":
+            warnings.warn(
+                f"int8 weights on {self.device} are dequantized on every call, "
+                "which is slower than the unquantized model"
+            )
+
+        names = ["query", "key", "value"] + (["out"] if attention_out else [])
+        for block in [*self.encoder.blocks, *self.decoder.blocks]:
+            for attn in [block.attn, block.cross_attn]:
+                if attn is None:
+                    continue
+                attn.qkv_weight = attn.qkv_bias = None
+                for name in names:
+                    setattr(attn, name, QuantLinear(getattr(attn, name)))
+            block.mlp[0] = QuantLinear(block.mlp[0])
+            block.mlp[2] = QuantLinear(block.mlp[2])
+
+    def new_kv_cache(self, n_batch: int, audio_features: Tensor):
+        """
+        Allocates the static-shape key/value cache used by `decode_step()`, along with the
+        cross-attention keys and values, which are projected once for all decoding steps.
+
+        Returns
+        -------
+        self_kv : Tuple[Tensor, Tensor]
+            zero-initialized self-attention key and value buffers for all decoder layers,
+            each of shape (n_text_layer, n_batch, n_text_ctx, n_text_state)
+        cross_kv : Tuple[Tensor, Tensor]
+            the cross-attention keys and values of `audio_features`, see `cross_attention_kv()`;
+            when `n_batch` is a multiple of the number of audio features, e.g. for beam search,
+            they are repeated for each group of consecutive sequences decoding the same audio
+        """
+        # the positions not filled yet are attended with zero weights, which needs finite values
+        shape = (
+            self.dims.n_text_layer,
+            n_batch,
+            self.dims.n_text_ctx,
+            self.dims.n_text_state,
+        )
+        self_kv = (audio_features.new_zeros(shape), audio_features.new_zeros(shape))
+        cross_kv = self.cross_attention_kv(audio_features)
+        if n_batch != audio_features.shape[0]:
+            n_group = n_batch // audio_features.shape[0]
+            cross_kv = tuple(kv.repeat_interleave(n_group, dim=1) for kv in cross_kv)
+        if self._compiled_decode_step is not None:
+            # the buffers are updated in-place by the compiled steps, which can only be
+            # captured as CUDA graphs when the mutated inputs keep static addresses
+            for buffer in [*self_kv, *cross_kv]:
+                torch._dynamo.mark_static_address(buffer)
+        return self_kv, cross_kv
+
+    def decode_step(
+        self,
+        tokens: Tensor,
+        audio_features: Tensor,
+        self_kv: Tuple[Tensor, Tensor],
+        cross_kv: Tuple[Tensor, Tensor],
+        offset: Tensor,
+    ) -> Tensor:
+        """
+        Runs the decoder on `tokens` located at `offset`, using and updating the cache returned
+        by `new_kv_cache()`. Single-token steps use the compiled function if
+        `compile_decode_step()` has been called; other calls such as the prefill run eagerly.
+        """
+        step = self.decoder.forward_with_cache
+        if self._compiled_decode_step is not None and tokens.shape[-1] == 1:
+            step = self._compiled_decode_step
+        return step(tokens, audio_features, self_kv, cross_kv, offset)
+
+    def compile_decode_step(self, **kwargs):
+        """
+        Compiles the single-token decoding steps with `torch.compile`; since they have static
+        shapes, they can be captured as a single graph without Python overhead between the layers.
+        `kwargs` are passed to `torch.compile`, by default using mode="reduce-overhead"; the caches
+        allocated by `new_kv_cache()` afterwards have static addresses to allow CUDA graphs.
+        """
+        kwargs = {"mode": "reduce-overhead", "fullgraph": True, **kwargs}
+        self._compiled_decode_step = torch.compile(
+            self.decoder.forward_with_cache, **kwargs
+        )
+
     def install_kv_cache_hooks(self, cache: Optional[dict] = None):
         """
         The `MultiHeadAttention` module optionally accepts `kv_cache` which stores the key and value
@@ -283,30 +710,62 @@ class Whisper(nn.Module):
         all caches, and the necessary hooks for the key and value projection modules that save the
         intermediate tensors to be reused during later calculations.
 
+        The self-attention caches are views into key and value buffers of shape
+        (n_text_layer, n_batch, n_text_ctx, n_text_state) that are allocated once, so that appending
+        a token writes only the new position instead of copying the whole history; modifying the
+        cached tensors in-place therefore updates the buffers as well.
+
         Returns
         -------
-        cache : Dict[nn.Module, torch.Tensor]
-            A dictionary object mapping the key/value projection modules to its cache
+        cache : Dict[Tuple[int, str], torch.Tensor]
+            A dictionary object mapping (layer index, "k" / "v" / "cross_k" / "cross_v") to the
+            cache of the corresponding key/value projection
         hooks : List[RemovableHandle]
             List of PyTorch RemovableHandle objects to stop the hooks to be called
         """
         cache = {**cache} if cache is not None else {}
+        buffers = {}
         hooks = []
 
-        def save_to_cache(module, _, output):
-            if module not in cache or output.shape[1] > self.dims.n_text_ctx:
-                # save as-is, for the first token or cross attention
-                cache[module] = output
-            else:
-                cache[module] = torch.cat([cache[module], output], dim=1).detach()
-            return cache[module]
+        # the cache key of each key/value projection: (layer index, kind)
+        slots = {}
+        for block in self.decoder.blocks:
+            for attn, prefix in [(block.attn, ""), (block.cross_attn, "cross_")]:
+                slots[attn.key] = (attn._layer_id, prefix + "k")
+                slots[attn.value] = (attn._layer_id, prefix + "v")
 
-        def install_hooks(layer: nn.Module):
-            if isinstance(layer, MultiHeadAttention):
-                hooks.append(layer.key.register_forward_hook(save_to_cache))
-                hooks.append(layer.value.register_forward_hook(save_to_cache))
+        def save_to_cache(module, _, output):
+            slot = slots[module]
+            layer, kind = slot
+            if kind.startswith("cross_"):
+                # save as-is, for cross attention
+                cache[slot] = output
+                return output
+
+            n_batch, n_ctx, n_state = output.shape
+            prev = cache.get(slot)
+            offset = 0 if prev is None else prev.shape[1]
+            buffer = buffers.get(kind)
+            if buffer is None or buffer.shape[1] != n_batch:
+                shape = (
+                    len(self.decoder.blocks),
+                    n_batch,
+                    self.dims.n_text_ctx,
+                    n_state,
+                )
+                buffer = buffers[kind] = output.new_empty(shape)
+            buffer = buffer[layer]
+            if prev is not None and prev.data_ptr() != buffer.data_ptr():
+                # the cache has been replaced, e.g. given as an argument
+                buffer[:, :offset] = prev
+
+            buffer[:, offset : offset + n_ctx] = output.detach()
+            cache[slot] = buffer[:, : offset + n_ctx]
+            return cache[slot]
+
+        for module in slots:
+            hooks.append(module.register_forward_hook(save_to_cache))
 
-        self.decoder.apply(install_hooks)
         return cache, hooks
 
     detect_language = detect_language_function
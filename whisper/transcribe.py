@@ -574,7 +574,8 @@ def cli():
 
     from . import load_model
 
-    model = load_model(model_name, device=device, download_root=model_dir)
+    dtype = torch.float16 if args["fp16"] and device.startswith("cuda") else None
+    model = load_model(model_name, device=device, download_root=model_dir, dtype=dtype)
 
     writer = get_writer(output_format, output_dir)
     word_options = [